@@ -3,6 +3,7 @@
 from __future__ import annotations
 
 import asyncio
+import functools
 import json
 import logging
 import logging.config
@@ -12,10 +13,11 @@ from pathlib import Path
 
 from lacuscore import LacusCore, CaptureStatus as CaptureStatusCore, CaptureResponse as CaptureResponseCore
 from pylacus import PyLacus, CaptureStatus as CaptureStatusPy, CaptureResponse as CaptureResponsePy
+from redis import Redis
 
 from lookyloo import Lookyloo, CaptureSettings
 from lookyloo.exceptions import LacusUnreachable
-from lookyloo.default import AbstractManager, get_config
+from lookyloo.default import AbstractManager, get_config, get_socket_path
 from lookyloo.helpers import get_captures_dir
 
 from lookyloo.modules import FOX
@@ -29,10 +31,17 @@ class AsyncCapture(AbstractManager):
         super().__init__(loglevel)
         self.script_name = 'async_capture'
         self.only_global_lookups: bool = get_config('generic', 'only_global_lookups')
+        self.default_public: bool = get_config('generic', 'default_public')
+        self.max_captures: int = get_config('generic', 'async_capture_processes')
         self.capture_dir: Path = get_captures_dir()
         self.lookyloo = Lookyloo()
+        # Redis connector so we don't build a new one from Lookyloo on every call
+        self.redis = Redis(unix_socket_path=get_socket_path('cache'), decode_responses=True)
 
         self.captures: set[asyncio.Task] = set()  # type: ignore[type-arg]
+        # With LacusCore, the captures are only done when one of the tasks above is over,
+        # no need to poll lacus otherwise. Always check on startup.
+        self.captures_to_process = True
 
         self.fox = FOX(config_name='FOX')
         if not self.fox.available:
@@ -44,7 +53,7 @@ class AsyncCapture(AbstractManager):
 
     async def _trigger_captures(self) -> None:
         # Only called if LacusCore is used
-        max_new_captures = get_config('generic', 'async_capture_processes') - len(self.captures)
+        max_new_captures = self.max_captures - len(self.captures)
         self.logger.debug(f'{len(self.captures)} ongoing captures.')
         if max_new_captures <= 0:
             self.logger.info(f'Max amount of captures in parallel reached ({len(self.captures)})')
@@ -52,18 +61,40 @@ class AsyncCapture(AbstractManager):
         for capture_task in self.lookyloo.lacus.consume_queue(max_new_captures):  # type: ignore[union-attr]
             self.captures.add(capture_task)
             capture_task.add_done_callback(self.captures.discard)
+            capture_task.add_done_callback(self._capture_done)
+
+    def _capture_done(self, _: asyncio.Task) -> None:  # type: ignore[type-arg]
+        self.captures_to_process = True
 
     def uuids_ready(self) -> list[str]:
         '''Get the list of captures ready to be processed'''
         # Only check if the top 50 in the priority list are done, as they are the most likely ones to be
         # and if the list it very very long, iterating over it takes a very long time.
-        return [uuid for uuid in self.lookyloo.redis.zrevrangebyscore('to_capture', 'Inf', '-Inf', start=0, num=50)
+        return [uuid for uuid in self.redis.zrevrangebyscore('to_capture', 'Inf', '-Inf', start=0, num=50)
                 if uuid and self.lookyloo.lacus.get_capture_status(uuid) in [CaptureStatusPy.DONE, CaptureStatusCore.DONE]]
 
-    def process_capture_queue(self) -> None:
+    async def process_capture_queue(self) -> None:
+        '''Process the captures ready in the capture queue'''
+        uuids = self.uuids_ready()
+        # NOTE: uuids_ready doesn't give the hand back to the loop, so no capture task can finish in between.
+        #       If some captures are ready, there may be more of them than the ones we got.
+        self.captures_to_process = bool(uuids)
+        if not uuids:
+            return None
+        # NOTE: store the captures in parallel, the semaphore must be created from the running loop.
+        semaphore = asyncio.Semaphore(self.max_captures)
+        results = await asyncio.gather(*[self._process_capture(uuid, semaphore) for uuid in uuids],
+                                       return_exceptions=True)
+        for uuid, result in zip(uuids, results):
+            if isinstance(result, LacusUnreachable):
+                raise result
+            if isinstance(result, Exception):
+                self.logger.error(f'Unable to process capture {uuid}: {result}', exc_info=result)
+
+    async def _process_capture(self, uuid: str, semaphore: asyncio.Semaphore) -> None:
         '''Process a query from the capture queue'''
         entries: CaptureResponseCore | CaptureResponsePy
-        for uuid in self.uuids_ready():
+        async with semaphore:
             if isinstance(self.lookyloo.lacus, LacusCore):
                 entries = self.lookyloo.lacus.get_capture(uuid, decode=True)
             elif isinstance(self.lookyloo.lacus, PyLacus):
@@ -75,19 +106,25 @@ class AsyncCapture(AbstractManager):
                 log = f'{log} - Runtime: {runtime}'
             self.logger.info(log)
 
-            self.lookyloo.redis.sadd('ongoing', uuid)
-            queue: str | None = self.lookyloo.redis.getdel(f'{uuid}_mgmt')
-
-            to_capture: CaptureSettings = self.lookyloo.redis.hgetall(uuid)  # type: ignore[assignment]
+            p = self.redis.pipeline(transaction=False)
+            p.sadd('ongoing', uuid)
+            p.getdel(f'{uuid}_mgmt')
+            p.hgetall(uuid)
+            queue: str | None
+            to_capture: CaptureSettings
+            _, queue, to_capture = p.execute()
 
-            if get_config('generic', 'default_public'):
+            if self.default_public:
                 # By default, the captures are on the index, unless the user mark them as un-listed
                 listing = False if ('listing' in to_capture and isinstance(to_capture['listing'], str) and to_capture['listing'].lower() in ['false', '0', '']) else True
             else:
                 # By default, the captures are not on the index, unless the user mark them as listed
                 listing = True if ('listing' in to_capture and isinstance(to_capture['listing'], str) and to_capture['listing'].lower() in ['true', '1']) else False
 
-            self.lookyloo.store_capture(
+            # NOTE: writing the capture on disk is blocking, and LacusCore captures are running
+            #       in the same event loop, do it in a thread.
+            dirpath = await asyncio.get_running_loop().run_in_executor(None, functools.partial(
+                self.lookyloo.store_capture,
                 uuid, listing,
                 os=to_capture.get('os'), browser=to_capture.get('browser'),
                 parent=to_capture.get('parent'),
@@ -98,8 +135,20 @@ class AsyncCapture(AbstractManager):
                 last_redirected_url=entries.get('last_redirected_url'),
                 cookies=entries.get('cookies'),
                 capture_settings=to_capture,
-                potential_favicons=entries.get('potential_favicons')
-            )
+                potential_favicons=entries.get('potential_favicons'),
+                add_to_lookup_dirs=False
+            ))
+
+            lazy_cleanup = self.redis.pipeline()
+            lazy_cleanup.hset('lookup_dirs', uuid, str(dirpath))
+            if queue and self.redis.zscore('queues', queue):
+                lazy_cleanup.zincrby('queues', -1, queue)
+            lazy_cleanup.zrem('to_capture', uuid)
+            lazy_cleanup.srem('ongoing', uuid)
+            lazy_cleanup.delete(uuid)
+            # make sure to expire the key if nothing was processed for a while (= queues empty)
+            lazy_cleanup.expire('queues', 600)
+            lazy_cleanup.execute()
 
             if 'auto_report' in to_capture:
                 send_report = True
@@ -119,15 +168,6 @@ class AsyncCapture(AbstractManager):
                                             comment=settings.get('comment'),
                                             recipient_mail=settings.get("recipient_mail"))
 
-            lazy_cleanup = self.lookyloo.redis.pipeline()
-            if queue and self.lookyloo.redis.zscore('queues', queue):
-                lazy_cleanup.zincrby('queues', -1, queue)
-            lazy_cleanup.zrem('to_capture', uuid)
-            lazy_cleanup.srem('ongoing', uuid)
-            lazy_cleanup.delete(uuid)
-            # make sure to expire the key if nothing was processed for a while (= queues empty)
-            lazy_cleanup.expire('queues', 600)
-            lazy_cleanup.execute()
             self.unset_running()
             self.logger.info(f'Done with {uuid}')
 
@@ -141,8 +181,11 @@ class AsyncCapture(AbstractManager):
                 # NOTE: +1 because running this method also counts for one and will
                 #       be decremented when it finishes
                 self.set_running(len(self.captures) + 1)
+                if not self.captures_to_process:
+                    # No capture finished since the last run, nothing to poll.
+                    return None
 
-            self.process_capture_queue()
+            await self.process_capture_queue()
         except LacusUnreachable:
             self.logger.error('Lacus is unreachable, retrying later.')
 
@@ -154,7 +197,7 @@ class AsyncCapture(AbstractManager):
                     await asyncio.sleep(5)
                     # NOTE: +1 so we don't quit before the final process capture queue
                     self.set_running(len(self.captures) + 1)
-                self.process_capture_queue()
+                await self.process_capture_queue()
                 self.unset_running()
             self.logger.info('No more captures')
         except LacusUnreachable:
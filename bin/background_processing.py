@@ -3,22 +3,28 @@
 from __future__ import annotations
 
 import json
-import time
 import logging
 import logging.config
-from collections import Counter
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, timedelta
-from typing import Any
+from typing import Any, Callable
 
 from lacuscore import CaptureStatus as CaptureStatusCore
 from lookyloo import Lookyloo
 from lookyloo.exceptions import LacusUnreachable
-from lookyloo.default import AbstractManager, get_config, get_homedir, safe_create_dir
+from lookyloo.default import AbstractManager, get_config, get_homedir, get_socket_path, safe_create_dir
 from lookyloo.helpers import ParsedUserAgent, serialize_to_json
 from pylacus import CaptureStatus as CaptureStatusPy
+from redis import Redis
 
 logging.config.dictConfig(get_config('logging'))
 
+# The settings passed to lacus when retrying to enqueue a capture, the document is fetched separately.
+ENQUEUE_FIELDS = ('url', 'document_name', 'browser', 'device_name', 'user_agent', 'proxy',
+                  'general_timeout_in_sec', 'cookies', 'headers', 'http_credentials', 'viewport',
+                  'referer', 'rendered_hostname_only', 'priority')
+
 
 class Processing(AbstractManager):
 
@@ -26,8 +32,12 @@ class Processing(AbstractManager):
         super().__init__(loglevel)
         self.script_name = 'processing'
         self.lookyloo = Lookyloo()
+        # Redis connector so we don't use the one from Lookyloo
+        self.redis = Redis(unix_socket_path=get_socket_path('cache'), decode_responses=True)
 
         self.use_own_ua = get_config('generic', 'use_user_agents_users')
+        # Captures unknown by lacus on the previous run
+        self.unknown_captures: set[str] = set()
 
     def _to_run_forever(self) -> None:
         if self.use_own_ua:
@@ -44,106 +54,139 @@ class Processing(AbstractManager):
             self.logger.debug(f'User-agent file for {yesterday} already exists.')
             return
         self.logger.info(f'Generating user-agent file for {yesterday}')
-        entries = self.lookyloo.redis.zrevrange(f'user_agents|{yesterday.isoformat()}', 0, -1)
+        # Get and remove the UA / IP mapping atomically, so no UA can be lost in between.
+        p = self.redis.pipeline()
+        p.zrevrange(f'user_agents|{yesterday.isoformat()}', 0, -1)
+        p.delete(f'user_agents|{yesterday.isoformat()}')
+        entries, _ = p.execute()
         if not entries:
             self.logger.info(f'No User-agent file for {yesterday} to generate.')
             return
 
-        to_store: dict[str, Any] = {'by_frequency': []}
-        uas = Counter([entry.split('|', 1)[1] for entry in entries])
+        by_platform: defaultdict[str, defaultdict[str, set[str]]] = defaultdict(lambda: defaultdict(set))
+        by_frequency: list[dict[str, str]] = []
+        uas = Counter(entry.split('|', 1)[1] for entry in entries)
         for ua, _ in uas.most_common():
             parsed_ua = ParsedUserAgent(ua)
-            if not parsed_ua.platform or not parsed_ua.browser:
+            platform, browser = parsed_ua.platform, parsed_ua.browser
+            if not platform or not browser:
                 continue
-            platform_key = parsed_ua.platform
-            if parsed_ua.platform_version:
-                platform_key = f'{platform_key} {parsed_ua.platform_version}'
-            browser_key = parsed_ua.browser
-            if parsed_ua.version:
-                browser_key = f'{browser_key} {parsed_ua.version}'
-            if platform_key not in to_store:
-                to_store[platform_key] = {}
-            if browser_key not in to_store[platform_key]:
-                to_store[platform_key][browser_key] = set()
-            to_store[platform_key][browser_key].add(parsed_ua.string)
-            to_store['by_frequency'].append({'os': platform_key,
-                                             'browser': browser_key,
-                                             'useragent': parsed_ua.string})
+            if platform_version := parsed_ua.platform_version:
+                platform = f'{platform} {platform_version}'
+            if version := parsed_ua.version:
+                browser = f'{browser} {version}'
+            by_platform[platform][browser].add(ua)
+            by_frequency.append({'os': platform, 'browser': browser, 'useragent': ua})
+        to_store: dict[str, Any] = {'by_frequency': by_frequency, **by_platform}
         with self_generated_ua_file.open('w') as f:
             json.dump(to_store, f, indent=2, default=serialize_to_json)
-
-        # Remove the UA / IP mapping.
-        self.lookyloo.redis.delete(f'user_agents|{yesterday.isoformat()}')
         self.logger.info(f'User-agent file for {yesterday} generated.')
 
+    def _get_capture_statuses(self, uuids: list[str]) -> dict[str, CaptureStatusCore | CaptureStatusPy]:
+        '''Get the status of the captures from lacus, in parallel'''
+        # NOTE: get the lacus instance from the main thread, it is initialized on first access.
+        get_capture_status = self.lookyloo.lacus.get_capture_status
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            return dict(zip(uuids, executor.map(get_capture_status, uuids)))
+
     def _retry_failed_enqueue(self) -> None:
         '''If enqueuing failed, the settings are added, with a UUID in the 'to_capture key', and they have a UUID'''
-        to_requeue: list[str] = []
+        uuids = [uuid for uuid, _ in self.redis.zscan_iter('to_capture')]
+        p = self.redis.pipeline(transaction=False)
+        for uuid in uuids:
+            p.hexists(uuid, 'not_queued')
+        not_queued = p.execute()
+        # The captures marked as not queued
+        to_requeue: list[str] = [uuid for uuid, is_not_queued in zip(uuids, not_queued) if is_not_queued]
         try:
-            for uuid, _ in self.lookyloo.redis.zscan_iter('to_capture'):
-                if self.lookyloo.redis.hexists(uuid, 'not_queued'):
-                    # The capture is marked as not queued
-                    to_requeue.append(uuid)
-                elif self.lookyloo.lacus.get_capture_status(uuid) in [CaptureStatusPy.UNKNOWN, CaptureStatusCore.UNKNOWN]:
-                    # The capture is unknown on lacus side. It might be a race condition.
-                    # Let's retry a few times.
-                    retry = 3
-                    while retry > 0:
-                        time.sleep(1)
-                        if self.lookyloo.lacus.get_capture_status(uuid) not in [CaptureStatusPy.UNKNOWN, CaptureStatusCore.UNKNOWN]:
-                            # Was a race condition, the UUID has been or is being processed by Lacus
-                            self.logger.info(f'UUID {uuid} was only temporary unknown')
-                            break
-                        retry -= 1
-                    else:
-                        # UUID is still unknown
-                        self.logger.info(f'UUID {uuid} is still unknown')
-                        to_requeue.append(uuid)
+            statuses = self._get_capture_statuses([uuid for uuid, is_not_queued in zip(uuids, not_queued) if not is_not_queued])
+            unknown = {uuid for uuid, status in statuses.items() if status in [CaptureStatusPy.UNKNOWN, CaptureStatusCore.UNKNOWN]}
+            for uuid in self.unknown_captures - unknown:
+                if uuid in statuses:
+                    # Was a race condition, the UUID has been or is being processed by Lacus
+                    self.logger.info(f'UUID {uuid} was only temporary unknown')
+            for uuid in unknown & self.unknown_captures:
+                # UUID is still unknown
+                self.logger.info(f'UUID {uuid} is still unknown')
+                to_requeue.append(uuid)
+            # The captures unknown on lacus side. It might be a race condition.
+            # Instead of blocking until it is solved, check them again on the next run.
+            self.unknown_captures = unknown
         except LacusUnreachable:
             self.logger.warning('Lacus still unreachable, trying again later')
             return None
 
+        if not to_requeue:
+            return None
+
+        p = self.redis.pipeline(transaction=False)
         for uuid in to_requeue:
-            if self.lookyloo.redis.zscore('to_capture', uuid) is None:
+            p.zscore('to_capture', uuid)
+            p.hmget(uuid, ENQUEUE_FIELDS)
+        results = p.execute()
+        queries: dict[str, dict[str, Any]] = {}
+        for uuid, score, values in zip(to_requeue, results[::2], results[1::2]):
+            if score is None:
                 # The capture has been captured in the meantime.
                 continue
             self.logger.info(f'Found a non-queued capture ({uuid}), retrying now.')
             # This capture couldn't be queued and we created the uuid locally
-            query = self.lookyloo.redis.hgetall(uuid)
-            try:
-                new_uuid = self.lookyloo.lacus.enqueue(
-                    url=query.get('url', None),
-                    document_name=query.get('document_name', None),
-                    document=query.get('document', None),
-                    # depth=query.get('depth', 0),
-                    browser=query.get('browser', None),
-                    device_name=query.get('device_name', None),
-                    user_agent=query.get('user_agent', None),
-                    proxy=query.get('proxy', None),
-                    general_timeout_in_sec=query.get('general_timeout_in_sec', None),
-                    cookies=query.get('cookies', None),
-                    headers=query.get('headers', None),
-                    http_credentials=query.get('http_credentials', None),
-                    viewport=query.get('viewport', None),
-                    referer=query.get('referer', None),
-                    rendered_hostname_only=query.get('rendered_hostname_only', True),
-                    # force=query.get('force', False),
-                    # recapture_interval=query.get('recapture_interval', 300),
-                    priority=query.get('priority', 0),
-                    uuid=uuid
-                )
-                if new_uuid != uuid:
-                    # somehow, between the check and queuing, the UUID isn't UNKNOWN anymore, just checking that
-                    self.logger.warning(f'Had to change the capture UUID (duplicate). Old: {uuid} / New: {new_uuid}')
-            except LacusUnreachable:
-                self.logger.warning('Lacus still unreachable.')
-                break
-            except Exception as e:
-                self.logger.warning(f'Still unable to enqueue capture: {e}')
-                break
-            else:
-                self.lookyloo.redis.hdel(uuid, 'not_queued')
-                self.logger.info(f'{uuid} enqueued.')
+            query = {field: value for field, value in zip(ENQUEUE_FIELDS, values) if value is not None}
+            if query.get('document_name'):
+                # Only pull the (potentially big) document if there is one.
+                query['document'] = self.redis.hget(uuid, 'document')
+            queries[uuid] = query
+
+        # NOTE: get the lacus instance from the main thread, it is initialized on first access.
+        enqueue = self.lookyloo.lacus.enqueue
+        p = self.redis.pipeline(transaction=False)
+        # NOTE: lacus doesn't have a bulk enqueue, submit them in parallel.
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            enqueued = {uuid: executor.submit(self._enqueue, enqueue, uuid, query) for uuid, query in queries.items()}
+            for uuid, future in enqueued.items():
+                if future.cancelled():
+                    continue
+                try:
+                    new_uuid = future.result()
+                    if new_uuid != uuid:
+                        # somehow, between the check and queuing, the UUID isn't UNKNOWN anymore, just checking that
+                        self.logger.warning(f'Had to change the capture UUID (duplicate). Old: {uuid} / New: {new_uuid}')
+                except LacusUnreachable:
+                    self.logger.warning('Lacus still unreachable.')
+                except Exception as e:
+                    self.logger.warning(f'Still unable to enqueue capture: {e}')
+                else:
+                    p.hdel(uuid, 'not_queued')
+                    self.logger.info(f'{uuid} enqueued.')
+                    continue
+                # Stop submitting to lacus: cancel the enqueues that haven't started yet,
+                # the ones already running are still collected.
+                for pending in enqueued.values():
+                    pending.cancel()
+        p.execute()
+
+    def _enqueue(self, enqueue: Callable[..., str], uuid: str, query: dict[str, Any]) -> str:
+        return enqueue(
+            url=query.get('url', None),
+            document_name=query.get('document_name', None),
+            document=query.get('document', None),
+            # depth=query.get('depth', 0),
+            browser=query.get('browser', None),
+            device_name=query.get('device_name', None),
+            user_agent=query.get('user_agent', None),
+            proxy=query.get('proxy', None),
+            general_timeout_in_sec=query.get('general_timeout_in_sec', None),
+            cookies=query.get('cookies', None),
+            headers=query.get('headers', None),
+            http_credentials=query.get('http_credentials', None),
+            viewport=query.get('viewport', None),
+            referer=query.get('referer', None),
+            rendered_hostname_only=query.get('rendered_hostname_only', True),
+            # force=query.get('force', False),
+            # recapture_interval=query.get('recapture_interval', 300),
+            priority=query.get('priority', 0),
+            uuid=uuid
+        )
 
 
 def main() -> None:
@@ -173,6 +173,7 @@ class UserAgents:
         # until we have a new version playwright, and restart everything anyway.
         self.playwright_devices = get_devices()
         self._load_newest_ua_file(ua_files_path[0])
+        self._last_ua_files_check = time.monotonic()
 
     def _load_newest_ua_file(self, path: Path) -> None:
         self.most_recent_ua_path = path
@@ -184,7 +185,7 @@ class UserAgents:
     def _load_playwright_devices(self) -> None:
         # Only get default and desktop for now.
         for device_name, details in self.playwright_devices['desktop']['default'].items():
-            parsed_ua = ParsedUserAgent(details['user_agent'])
+            parsed_ua = get_parsed_ua(details['user_agent'])
             if not parsed_ua.platform or not parsed_ua.browser:
                 continue
             platform_key = parsed_ua.platform
@@ -204,15 +205,18 @@ class UserAgents:
 
     @property
     def user_agents(self) -> dict[str, dict[str, list[str]]]:
-        ua_files_path = sorted(self.path.glob('**/*.json'), reverse=True)
-        if ua_files_path[0] != self.most_recent_ua_path:
-            self._load_newest_ua_file(ua_files_path[0])
+        # NOTE: There is at most one new file a day, no need to walk the directory on every call.
+        if time.monotonic() - self._last_ua_files_check > 60:
+            ua_files_path = sorted(self.path.glob('**/*.json'), reverse=True)
+            if ua_files_path[0] != self.most_recent_ua_path:
+                self._load_newest_ua_file(ua_files_path[0])
+            self._last_ua_files_check = time.monotonic()
         return self.most_recent_uas
 
-    @property
+    @cached_property
     def default(self) -> dict[str, str]:
         '''The default useragent for desktop chrome from playwright'''
-        parsed_ua = ParsedUserAgent(self.playwright_devices['desktop']['default']['Desktop Chrome']['user_agent'])
+        parsed_ua = get_parsed_ua(self.playwright_devices['desktop']['default']['Desktop Chrome']['user_agent'])
         platform_key = parsed_ua.platform
         if parsed_ua.platform_version:
             platform_key = f'{platform_key} {parsed_ua.platform_version}'
@@ -389,3 +393,9 @@ class ParsedUserAgent(UserAgent):
 
     def __str__(self) -> str:
         return f'OS: {self.platform} - Browser: {self.browser} {self.version} - UA: {self.string}'
+
+
+@lru_cache(1024)
+def get_parsed_ua(ua: str) -> ParsedUserAgent:
+    '''Parsing a user agent is slow, and the same ones are used over and over again.'''
+    return ParsedUserAgent(ua)
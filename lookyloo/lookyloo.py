@@ -15,6 +15,7 @@ import ssl
 import time
 
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, datetime, timedelta, timezone
 from functools import lru_cache
 from email.message import EmailMessage
@@ -57,7 +58,7 @@ from .exceptions import (MissingCaptureDirectory,
                          MissingUUID, TreeNeedsRebuild, NoValidHarFile, LacusUnreachable)
 from .helpers import (get_captures_dir, get_email_template,
                       get_resources_hashes, get_taxonomies,
-                      uniq_domains, ParsedUserAgent, load_cookies, UserAgents,
+                      uniq_domains, get_parsed_ua, load_cookies, UserAgents,
                       get_useragent_for_requests, make_ts_from_dirname, load_takedown_filters
                       )
 from .modules import (MISPs, PhishingInitiative, UniversalWhois,
@@ -121,6 +122,8 @@ class Lookyloo():
         self.redis_pool: ConnectionPool = ConnectionPool(connection_class=UnixDomainSocketConnection,
                                                          path=get_socket_path('cache'), decode_responses=True)
         self.capture_dir: Path = get_captures_dir()
+        # Used by store_capture, the threads are only started when needed.
+        self._har_writer = ThreadPoolExecutor(thread_name_prefix='har_writer')
 
         self._priority = get_config('generic', 'priority')
 
@@ -292,7 +295,7 @@ class Lookyloo():
         if not cache.user_agent:
             return {}
         meta = {}
-        ua = ParsedUserAgent(cache.user_agent)
+        ua = get_parsed_ua(cache.user_agent)
         meta['user_agent'] = ua.string
         if ua.platform:
             meta['os'] = ua.platform
@@ -1417,6 +1420,10 @@ class Lookyloo():
 
         return statistics
 
+    def _write_har(self, dirpath: Path, har: dict[str, Any]) -> None:
+        with gzip.open(dirpath / '0.har.gz', 'wb') as f_out:
+            f_out.write(json.dumps(har).encode())
+
     def store_capture(self, uuid: str, is_public: bool,
                       os: str | None=None, browser: str | None=None,
                       parent: str | None=None,
@@ -1426,13 +1433,22 @@ class Lookyloo():
                       last_redirected_url: str | None=None,
                       cookies: list[Cookie] | list[dict[str, str]] | None=None,
                       capture_settings: CaptureSettings | None=None,
-                      potential_favicons: set[bytes] | None=None
-                      ) -> None:
+                      potential_favicons: set[bytes] | None=None,
+                      add_to_lookup_dirs: bool=True
+                      ) -> Path:
+        '''Store a capture on disk.
+        :param add_to_lookup_dirs: If False, the caller is in charge of adding the returned directory to lookup_dirs
+        '''
 
         now = datetime.now()
         dirpath = self.capture_dir / str(now.year) / f'{now.month:02}' / f'{now.day:02}' / now.isoformat()
         safe_create_dir(dirpath)
 
+        # NOTE: The HAR is by far the biggest file, and the compression releases the GIL:
+        #       write it in parallel to the other files.
+        har_written = self._har_writer.submit(self._write_har, dirpath, har) if har else None
+
+        # NOTE: json.dump uses the pure python encoder, json.dumps uses the C one.
         if os or browser:
             meta: dict[str, str] = {}
             if os:
@@ -1440,7 +1456,7 @@ class Lookyloo():
             if browser:
                 meta['browser'] = browser
             with (dirpath / 'meta').open('w') as _meta:
-                json.dump(meta, _meta)
+                _meta.write(json.dumps(meta))
 
         # Write UUID
         with (dirpath / 'uuid').open('w') as _uuid:
@@ -1465,11 +1481,7 @@ class Lookyloo():
 
         if error:
             with (dirpath / 'error.txt').open('w') as _error:
-                json.dump(error, _error)
-
-        if har:
-            with gzip.open(dirpath / '0.har.gz', 'wt') as f_out:
-                f_out.write(json.dumps(har))
+                _error.write(json.dumps(error))
 
         if png:
             with (dirpath / '0.png').open('wb') as _img:
@@ -1482,8 +1494,8 @@ class Lookyloo():
             except UnicodeEncodeError:
                 # NOTE: Unable to store as string, try to store as bytes instead
                 #        Yes, it is dirty.
-                with (dirpath / '0.html').open('wb') as _html:
-                    _html.write(html.encode('utf-16', 'surrogatepass'))
+                with (dirpath / '0.html').open('wb') as _html_bytes:
+                    _html_bytes.write(html.encode('utf-16', 'surrogatepass'))
 
         if last_redirected_url:
             with (dirpath / '0.last_redirect.txt').open('w') as _redir:
@@ -1491,15 +1503,21 @@ class Lookyloo():
 
         if cookies:
             with (dirpath / '0.cookies.json').open('w') as _cookies:
-                json.dump(cookies, _cookies)
+                _cookies.write(json.dumps(cookies))
 
         if capture_settings:
             with (dirpath / 'capture_settings.json').open('w') as _cs:
-                json.dump(capture_settings, _cs)
+                _cs.write(json.dumps(capture_settings))
 
         if potential_favicons:
             for f_id, favicon in enumerate(potential_favicons):
                 with (dirpath / f'{f_id}.potential_favicons.ico').open('wb') as _fw:
                     _fw.write(favicon)
 
-        self.redis.hset('lookup_dirs', uuid, str(dirpath))
+        if har_written:
+            # Raises if the HAR couldn't be written
+            har_written.result()
+
+        if add_to_lookup_dirs:
+            self.redis.hset('lookup_dirs', uuid, str(dirpath))
+        return dirpath